@@ -149,7 +149,7 @@ in python310Packages.buildPythonPackage {
   '';
 
   propagatedBuildInputs =
-    (with python310Packages; [ discordpy setuptools haversine tomli tomli-w ])
+    (with python310Packages; [ discordpy setuptools orjson tomli tomli-w ])
     ++ [ pyhafas ]
     ++ [ perl perlPackages.JSON hafas-m TravelStatusDEDBWagenreihung ];
   format = "pyproject";
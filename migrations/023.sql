@@ -0,0 +1,3 @@
+-- every webhook looks up messages per user and trip/channel, don't scan the whole table for that
+CREATE INDEX IF NOT EXISTS messages_user_channel_message ON messages(user_id, channel_id, message_id);
+CREATE INDEX IF NOT EXISTS messages_user_journey ON messages(user_id, journey_id);
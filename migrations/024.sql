@@ -0,0 +1,2 @@
+-- bumped on every write to a trip, so we can tell if our copy of it is stale
+ALTER TABLE trips ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,2 @@
+-- the primary key starts with journey_id, so finding a user's trips had to scan the whole table
+CREATE INDEX IF NOT EXISTS trips_user_from_time ON trips(user_id, from_time);
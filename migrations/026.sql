@@ -0,0 +1,2 @@
+-- missing headsigns are NULL now, "?" is only for display
+UPDATE trips SET headsign = NULL WHERE headsign = '?';
@@ -1,12 +1,14 @@
 "contains our bot commands and the incoming webhook handler"
 import asyncio
 import base64
+import functools
 import itertools
 import json
 import secrets
 import re
 import shlex
 import subprocess
+import time
 import traceback
 import typing
 import urllib
@@ -14,10 +16,10 @@ from copy import deepcopy
 from datetime import datetime, timedelta, timezone as dt_tz
 from zoneinfo import ZoneInfo
 
-from aiohttp import ClientSession, web
+from aiohttp import web
 import discord
 from discord.ext import commands
-from haversine import haversine
+import orjson
 import tomli
 import tomli_w
 
@@ -28,22 +30,28 @@ from .format import (
     emoji,
     format_travelynx,
     get_display,
+    known_networks,
+    sorted_train_types,
     train_types_config,
 )
 from .helpers import (
     available_tzs,
+    close_http_session,
     format_composition_element,
     format_time,
     generate_train_link,
+    get_http_session,
+    haversine_km,
+    rough_distance_km,
     is_token_valid,
+    json_merge_patch,
     not_registered_embed,
+    parse_train,
     train_type_color,
     trip_length,
     zugid,
     tz,
-    random_id,
     parse_manual_time,
-    fetch_headsign,
 )
 
 config = {}
@@ -70,15 +78,29 @@ async def setup_hook():
 bot.setup_hook = setup_hook
 
 
+async def close():
+    "close our shared http session together with the bot"
+    await close_http_session()
+    await commands.Bot.close(bot)
+
+
+bot.close = close
+
+
 @bot.event
 async def on_ready():
     "once we're logged in, set up commands and start the web server"
-    for server in servers:
-        await bot.tree.sync(guild=server)
+    await asyncio.gather(*[bot.tree.sync(guild=server) for server in servers])
     bot.loop.create_task(receive(bot))
     print(f"logged in as {bot.user}")
 
 
+# how far and how long a changeover may take before we consider it a new journey
+MAX_CHANGE_DISTANCE = 2.0  # km
+MAX_CHANGE_DURATION = 2 * 60 * 60  # seconds
+NULL_ISLAND = (0.0, 0.0)
+
+
 async def handle_status_update(userid, reason, status):
     """update trip data in the database, also starting a new journey if the last data
     we have is too old or distant for this to be a changeover"""
@@ -88,14 +110,15 @@ async def handle_status_update(userid, reason, status):
     def is_new_journey(old, new):
         "determine if the user has merely changed into a new transport or if they have started another journey altogether"
 
-        # don't drop the journey in case we receive a checkout after the new checkin
-        if reason == "checkout" and status["train"]["id"] in [
-            trip.status["train"]["id"]
-            for trip in DB.Trip.find_current_trips_for(user.discord_id)
-        ]:
+        # still on the same train, by far the most common case
+        if old["train"]["id"] == new["train"]["id"]:
             return False
 
-        if old["train"]["id"] == new["train"]["id"]:
+        # don't drop the journey in case we receive a checkout after the new checkin
+        if reason == "checkout" and any(
+            trip.status["train"]["id"] == status["train"]["id"]
+            for trip in DB.Trip.find_current_trips_for(user.discord_id)
+        ):
             return False
 
         if user.break_journey == DB.BreakMode.FORCE_BREAK:
@@ -108,175 +131,223 @@ async def handle_status_update(userid, reason, status):
 
         change_from = old["toStation"]
         change_to = new["fromStation"]
-        change_distance = haversine(
-            (change_from["latitude"], change_from["longitude"]),
-            (change_to["latitude"], change_to["longitude"]),
-        )
-        change_duration = datetime.fromtimestamp(
-            change_to["realTime"], tz=tz
-        ) - datetime.fromtimestamp(change_from["realTime"], tz=tz)
+        from_coords = (change_from["latitude"], change_from["longitude"])
+        to_coords = (change_to["latitude"], change_to["longitude"])
+        # same station or faked station without coordinates, no need to do trig for that
+        if change_from["uic"] == change_to["uic"] or NULL_ISLAND in (
+            from_coords,
+            to_coords,
+        ):
+            change_distance = 0.0
+        else:
+            change_distance = rough_distance_km(*from_coords, *to_coords)
+            # only do the exact math if the cheap estimate is anywhere near the cutoff
+            if change_distance < 2 * MAX_CHANGE_DISTANCE:
+                change_distance = haversine_km(*from_coords, *to_coords)
+        change_duration = change_to["realTime"] - change_from["realTime"]
 
         return (
-            change_distance > 2.0
+            change_distance > MAX_CHANGE_DISTANCE
             and not "travelhookfaked" in (new["train"]["id"] + old["train"]["id"])
-        ) or change_duration > timedelta(hours=2)
+        ) or change_duration > MAX_CHANGE_DURATION
 
-    if (last_trip := DB.Trip.find_last_trip_for(userid)) and is_new_journey(
-        last_trip.status, status
-    ):
-        user.do_break_journey()
-
-    DB.Trip.upsert(userid, status)
-    trip = DB.Trip.find(userid, zugid(status))
-    trip.fetch_hafas_data()
-    trip.maybe_fix_circle_line()
-    trip.maybe_fix_1970()
-    trip.fetch_headsign()
+    with DB.transaction():
+        if (last_trip := DB.Trip.find_last_trip_for(userid)) and is_new_journey(
+            last_trip.status, status
+        ):
+            user.do_break_journey()
+
+        trip = DB.Trip.upsert(userid, status)
+    # these talk to hafas, don't hold the write lock while waiting on it
+    await trip.fetch_hafas_data()
+    await trip.maybe_fix_circle_line()
+    await trip.maybe_fix_1970()
+    await trip.fetch_headsign()
     await trip.get_oebb_composition()
-    trip.get_db_composition()
+    await trip.get_db_composition()
+    DB.invalidate_request_cache()
 
 
-async def receive(bot):
-    """our own little web server that receives incoming webhooks from
-    travelynx and runs the live feed for the users that have enabled it"""
+WEBHOOK_REASONS = frozenset(("update", "checkin", "ping", "checkout", "undo"))
 
-    async def handler(req):
-        user = DB.User.find(
-            token_webhook=req.headers["authorization"].removeprefix("Bearer ")
-        )
-        if not user:
-            print(f"unknown user {req.headers['authorization']}")
-            return
 
-        async with user.get_lock():
-            userid = user.discord_id
-            data = await req.json()
+async def process_webhook(user, data):
+    """handle a webhook from travelynx (or one we made up ourselves) for an already authenticated user.
+    returns the text to respond with, or None if there is nothing to do"""
+    cache_token = DB.request_cache.set({})
+    try:
+        return await _process_webhook(user, data)
+    finally:
+        DB.request_cache.reset(cache_token)
 
-            if data["reason"] == "ping" and not data["status"]["checkedIn"]:
-                return web.Response(text="travelynx relay bot successfully connected!")
 
-            if (
-                not data["reason"] in ("update", "checkin", "ping", "checkout", "undo")
-                or not data["status"]["toStation"]["name"]
-            ):
-                raise web.HTTPNoContent()
+async def _process_webhook(user, data):
+    async with user.get_lock():
+        userid = user.discord_id
+        reason = data["reason"]
+        status = data["status"]
 
-            # hopefully debug this mess eventually
+        if reason == "ping" and not status["checkedIn"]:
+            return "travelynx relay bot successfully connected!"
+
+        if not reason in WEBHOOK_REASONS or not status["toStation"]["name"]:
+            return None
+
+        jid = zugid(status)
+        train_type = status["train"]["type"]
+        train_no = status["train"]["no"]
+
+        # hopefully debug this mess eventually
+        # rendering the display and link is expensive (the link gets shortened in the database),
+        # so only do it if we're actually debugging
+        if config.get("debug"):
             print(
                 userid,
-                data["reason"],
-                get_display(bot, data["status"]),
-                generate_train_link(data["status"]),
+                reason,
+                get_display(bot, status),
+                generate_train_link(status),
             )
-
-            # when checkin is undone, delete its message
-            if data["reason"] == "undo" and not data["status"]["checkedIn"]:
-                last_trip = DB.Trip.find_last_trip_for(user.discord_id)
-                if not last_trip.status["checkedIn"]:
-                    print("sussy")
-                    return web.Response(
-                        text="Not unpublishing last checkin — you're already checked out. "
-                        "In case this is intentional and you want to force deletion, undo your checkout, "
-                        "save the journey comment once, and then finally undo your checkin. Sorry for the hassle."
-                    )
-
-                messages_to_delete = DB.Message.find_all(
-                    user.discord_id, last_trip.journey_id
+        else:
+            print(userid, reason, train_type, train_no)
+
+        # when checkin is undone, delete its message
+        if reason == "undo" and not status["checkedIn"]:
+            last_trip = DB.Trip.find_last_trip_for(userid)
+            if not last_trip.status["checkedIn"]:
+                print("sussy")
+                return (
+                    "Not unpublishing last checkin — you're already checked out. "
+                    "In case this is intentional and you want to force deletion, undo your checkout, "
+                    "save the journey comment once, and then finally undo your checkin. Sorry for the hassle."
                 )
-                for message in messages_to_delete:
-                    await message.delete(bot)
-                last_trip.delete()
 
-                if current_trips := DB.Trip.find_current_trips_for(user.discord_id):
-                    for message in DB.Message.find_all(
-                        user.discord_id, current_trips[-1].journey_id
-                    ):
-                        msg = await message.fetch(bot)
-                        await msg.edit(
-                            embed=format_travelynx(bot, userid, current_trips),
-                            view=None,
-                        )
+            messages_to_delete = DB.Message.find_all(userid, last_trip.journey_id)
+            for message in messages_to_delete:
+                await message.delete(bot)
+            last_trip.delete()
+            DB.invalidate_request_cache()
 
-                return web.Response(
-                    text=f"Unpublished last checkin for {len(messages_to_delete)} channels"
-                )
+            if current_trips := DB.Trip.find_current_trips_for(userid):
+                for message in DB.Message.find_all(
+                    userid, current_trips[-1].journey_id
+                ):
+                    msg = await message.fetch(bot)
+                    await msg.edit(
+                        embed=format_travelynx(bot, userid, current_trips),
+                        view=None,
+                    )
 
-            # don't share completely private checkins, only unlisted and upwards
-            if data["status"]["visibility"]["desc"] == "private":
-                # just to make sure we don't have it lying around for some reason anyway
-                if trip := DB.Trip.find(user.discord_id, zugid(data["status"])):
-                    trip.delete()
-                return web.Response(
-                    text=f'Not publishing private {data["reason"]} in {data["status"]["train"]["type"]} {data["status"]["train"]["no"]}'
-                )
+            return f"Unpublished last checkin for {len(messages_to_delete)} channels"
 
-            # update database to maintain trip data
-            await handle_status_update(userid, data["reason"], data["status"])
+        # don't share completely private checkins, only unlisted and upwards
+        if status["visibility"]["desc"] == "private":
+            # just to make sure we don't have it lying around for some reason anyway
+            if trip := DB.Trip.find(userid, jid):
+                trip.delete()
+            return f"Not publishing private {reason} in {train_type} {train_no}"
 
-            current_trips = DB.Trip.find_current_trips_for(user.discord_id)
+        # update database to maintain trip data
+        await handle_status_update(userid, reason, status)
 
-            # get all channels that live updates get pushed to for this user
-            channels = [bot.get_channel(cid) for cid in user.find_live_channel_ids()]
-            for channel in channels:
-                member = channel.guild.get_member(user.discord_id)
-                # don't post if the user has left or can't see the live channel
-                if not member or not channel.permissions_for(member).read_messages:
-                    continue
+        current_trips = DB.Trip.find_current_trips_for(userid)
 
-                # check if we already have a message for this particular trip
-                # edit it if it exists, otherwise create a new one and submit it into the database
-                if message := DB.Message.find(
-                    userid, zugid(data["status"]), channel.id
-                ):
-                    # if we get a checkout after another checkin has already been posted (manually)
-                    # stop pretending we're at the end of the journey and link to the new ones
-                    continue_link = None
-                    if newer_message := DB.Message.find_newer_than(
-                        userid, channel.id, message.message_id
-                    ):
-                        continue_link = (await newer_message.fetch(bot)).jump_url
-                        current_trip_index = [
-                            trip.journey_id for trip in current_trips
-                        ].index(zugid(data["status"]))
-                        current_trips = current_trips[0 : current_trip_index + 1]
+        # get all channels that live updates get pushed to for this user
+        # resolve them and their member once up front instead of per channel update
+        channels = []
+        for cid in user.find_live_channel_ids():
+            channel = bot.get_channel(cid)
+            # the channel might have been deleted or we can't see it anymore
+            if not channel:
+                continue
+            member = channel.guild.get_member(userid)
+            # don't post if the user has left or can't see the live channel
+            if member and channel.permissions_for(member).read_messages:
+                channels.append(channel)
+        channel_ids = [channel.id for channel in channels]
+        messages = DB.Message.find_many(userid, jid, channel_ids)
+        prev_messages = {}
+        if len(current_trips) > 1:
+            prev_messages = DB.Message.find_many(
+                userid, current_trips[-2].journey_id, channel_ids
+            )
 
-                    msg = await message.fetch(bot)
-                    await msg.edit(
+        async def update_channel(channel):
+            "post or edit the message for this trip in one live channel"
+            trips = current_trips
+            # check if we already have a message for this particular trip
+            # edit it if it exists, otherwise create a new one and submit it into the database
+            if message := messages.get(channel.id):
+                # if we get a checkout after another checkin has already been posted (manually)
+                # stop pretending we're at the end of the journey and link to the new ones
+                continue_link = None
+                if newer_message := DB.Message.find_newer_than(
+                    userid, channel.id, message.message_id
+                ):
+                    continue_link = (await newer_message.fetch(bot)).jump_url
+                    current_trip_index = [trip.journey_id for trip in trips].index(jid)
+                    trips = trips[0 : current_trip_index + 1]
+
+                msg = await message.fetch(bot)
+                await msg.edit(
+                    embed=format_travelynx(
+                        bot,
+                        userid,
+                        trips,
+                        continue_link=continue_link,
+                    ),
+                    view=TripActionsView(trips[-1]),
+                )
+            else:
+                message = await channel.send(
+                    embed=format_travelynx(bot, userid, trips),
+                    view=TripActionsView(trips[-1]),
+                )
+                DB.Message(jid, userid, channel.id, message.id).write()
+                # shrink previous message to prevent clutter
+                if len(trips) > 1 and (prev_message := prev_messages.get(channel.id)):
+                    prev_msg = await prev_message.fetch(bot)
+                    await prev_msg.edit(
                         embed=format_travelynx(
                             bot,
                             userid,
-                            current_trips,
-                            continue_link=continue_link,
+                            trips[0:-1],
+                            continue_link=message.jump_url,
                         ),
-                        view=TripActionsView(current_trips[-1]),
-                    )
-                else:
-                    message = await channel.send(
-                        embed=format_travelynx(bot, userid, current_trips),
-                        view=TripActionsView(current_trips[-1]),
+                        view=None,
                     )
-                    DB.Message(
-                        zugid(data["status"]), user.discord_id, channel.id, message.id
-                    ).write()
-                    # shrink previous message to prevent clutter
-                    if len(current_trips) > 1 and (
-                        prev_message := DB.Message.find(
-                            user.discord_id, current_trips[-2].journey_id, channel.id
-                        )
-                    ):
-                        prev_msg = await prev_message.fetch(bot)
-                        await prev_msg.edit(
-                            embed=format_travelynx(
-                                bot,
-                                userid,
-                                current_trips[0:-1],
-                                continue_link=message.jump_url,
-                            ),
-                            view=None,
-                        )
-            return web.Response(
-                text=f'Successfully published {data["status"]["train"]["type"]} {data["status"]["train"]["no"]} {data["reason"]} to {len(channels)} channels'
-            )
+
+        published = 0
+        for channel, result in zip(
+            channels,
+            await asyncio.gather(
+                *[update_channel(channel) for channel in channels],
+                return_exceptions=True,
+            ),
+        ):
+            if isinstance(result, BaseException):
+                print(f"error while updating channel {channel.id}:")
+                traceback.print_exception(result)
+            else:
+                published += 1
+        return f"Successfully published {train_type} {train_no} {reason} to {published} channels"
+
+
+async def receive(bot):
+    """our own little web server that receives incoming webhooks from
+    travelynx and runs the live feed for the users that have enabled it"""
+
+    async def handler(req):
+        user = DB.User.find(
+            token_webhook=req.headers["authorization"].removeprefix("Bearer ")
+        )
+        if not user:
+            print(f"unknown user {req.headers['authorization']}")
+            return
+
+        text = await process_webhook(user, orjson.loads(await req.read()))
+        if text is None:
+            raise web.HTTPNoContent()
+        return web.Response(text=text)
 
     async def unshortener(req):
         link = DB.Link.find_by_short(short_id=req.match_info["randid"])
@@ -320,32 +391,31 @@ async def zug(ia, member: typing.Optional[discord.Member]):
         return
 
     await ia.response.defer()
-    async with ClientSession() as session:
-        async with session.get(
-            f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
-        ) as r:
-            if r.status == 200:
-                status = await r.json()
-                if status["checkedIn"] and (status["visibility"]["desc"] != "private"):
-                    await handle_status_update(member.id, "update", status)
-
-            current_trips = DB.Trip.find_current_trips_for(member.id)
-            if current_trips and (
-                current_trips[-1].status["checkedIn"]
-                or current_trips[-1].status["toStation"]["realTime"]
-                > datetime.utcnow().timestamp()
-            ):
-                await ia.edit_original_response(
-                    embed=format_travelynx(bot, member.id, current_trips),
-                    view=TripActionsView(current_trips[-1]),
-                )
-            else:
-                await ia.edit_original_response(
-                    embed=discord.Embed().set_author(
-                        name=f"{member.name} ist gerade nicht unterwegs",
-                        icon_url=member.avatar.url,
-                    )
+    async with get_http_session().get(
+        f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
+    ) as r:
+        if r.status == 200:
+            status = await r.json(loads=orjson.loads)
+            if status["checkedIn"] and (status["visibility"]["desc"] != "private"):
+                await handle_status_update(member.id, "update", status)
+
+        current_trips = DB.Trip.find_current_trips_for(member.id)
+        if current_trips and (
+            current_trips[-1].status["checkedIn"]
+            or current_trips[-1].status["toStation"]["realTime"]
+            > datetime.utcnow().timestamp()
+        ):
+            await ia.edit_original_response(
+                embed=format_travelynx(bot, member.id, current_trips),
+                view=TripActionsView(current_trips[-1]),
+            )
+        else:
+            await ia.edit_original_response(
+                embed=discord.Embed().set_author(
+                    name=f"{member.name} ist gerade nicht unterwegs",
+                    icon_url=member.avatar.url,
                 )
+            )
 
 
 class TripActionsView(discord.ui.View):
@@ -394,27 +464,26 @@ class TripActionsView(discord.ui.View):
         and replaced with a disabled button for fake checkins"""
         user = DB.User.find(discord_id=self.trip.user_id)
         await ia.response.defer()
-        async with ClientSession() as session:
-            async with session.get(
-                f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
-            ) as r:
-                if r.status == 200:
-                    data = await r.json()
-                    if data["checkedIn"] and self.trip.journey_id == zugid(data):
-                        await handle_status_update(self.trip.user_id, "update", data)
-                        self.trip.fetch_hafas_data(force=True)
-                        await ia.edit_original_response(
-                            embed=format_travelynx(
-                                bot,
-                                self.trip.user_id,
-                                DB.Trip.find_current_trips_for(self.trip.user_id),
-                            ),
-                            view=self,
-                        )
-                    else:
-                        await ia.followup.send(
-                            "Die Fahrt ist bereits zu Ende.", ephemeral=True
-                        )
+        async with get_http_session().get(
+            f"{config['travelynx_instance']}/api/v1/status/{user.token_status}"
+        ) as r:
+            if r.status == 200:
+                data = await r.json(loads=orjson.loads)
+                if data["checkedIn"] and self.trip.journey_id == zugid(data):
+                    await handle_status_update(self.trip.user_id, "update", data)
+                    await self.trip.fetch_hafas_data(force=True)
+                    await ia.edit_original_response(
+                        embed=format_travelynx(
+                            bot,
+                            self.trip.user_id,
+                            DB.Trip.find_current_trips_for(self.trip.user_id),
+                        ),
+                        view=self,
+                    )
+                else:
+                    await ia.followup.send(
+                        "Die Fahrt ist bereits zu Ende.", ephemeral=True
+                    )
 
     @discord.ui.button(label="Copy", style=discord.ButtonStyle.secondary)
     async def manualcopy(self, ia, _):
@@ -426,13 +495,14 @@ class TripActionsView(discord.ui.View):
             return
 
         # update, just in case we missed some edits maybe
-        self.trip = DB.Trip.find(self.trip.user_id, self.trip.journey_id)
+        if not self.trip.is_current():
+            self.trip = DB.Trip.find(self.trip.user_id, self.trip.journey_id)
         departure = self.trip.status["fromStation"]["scheduledTime"]
         departure_delay = (
-            departure - self.trip.status["fromStation"]["scheduledTime"]
+            self.trip.status["fromStation"]["realTime"] - departure
         ) // 60
         arrival = self.trip.status["toStation"]["scheduledTime"]
-        arrival_delay = (arrival - self.trip.status["toStation"]["scheduledTime"]) // 60
+        arrival_delay = (self.trip.status["toStation"]["realTime"] - arrival) // 60
         await manualtrip.callback(
             ia,
             self.trip.status["fromStation"]["name"],
@@ -636,25 +706,33 @@ async def _break(ia, break_mode: Choice[int]):
             )
 
 
+@functools.lru_cache(maxsize=64)
+def fold_suggestions(suggestions):
+    "split and casefold a user's saved suggestions once instead of on every keystroke"
+    return tuple((s, s.casefold()) for s in dict.fromkeys(suggestions.split("\n")) if s)
+
+
 async def manual_station_autocomplete(ia, current):
     suggestions = []
     if user := DB.User.find(ia.user.id):
-        trips = DB.Trip.find_current_trips_for(user.discord_id)
-        for trip in trips:
-            suggestions += [
+        needle = current.casefold()
+        candidates = []
+        for trip in DB.Trip.find_current_trips_for(user.discord_id):
+            for name in (
                 trip.status["toStation"]["name"],
                 trip.status["fromStation"]["name"],
-            ]
-        suggestions += user.suggestions.split("\n")
-        suggestions = [s for s in suggestions if current.casefold() in s.casefold()]
+            ):
+                candidates.append((name, name.casefold()))
+        candidates += fold_suggestions(user.suggestions)
+        suggestions = [s for s, folded in candidates if needle in folded]
 
-    return [Choice(name=s, value=s) for s in set(suggestions)]
+    # keep the order and stay below discord's limit of 25 choices
+    return [Choice(name=s, value=s) for s in list(dict.fromkeys(suggestions))[:25]]
 
 
 async def train_types_autocomplete(ia, current):
-    train_types = train_types_config["train_types"]
-    train_types = set([tt.get("type") for tt in train_types if tt.get("type")])
-    suggestions = sorted([s for s in train_types if current.casefold() in s.casefold()])
+    needle = current.casefold()
+    suggestions = [s for s in sorted_train_types if needle in s.casefold()]
 
     return [Choice(name=s, value=s) for s in suggestions[:25]]
 
@@ -663,6 +741,9 @@ re_walk_distance = re.compile(
     r"(?P<type>walk |bike )(?P<number>\d+(?:.\d+)?)(?P<unit>k?m)"
 )
 
+# unique suffix for faked trip ids, doesn't need to be random at all
+fake_trip_ids = itertools.count()
+
 
 @journey.command()
 @discord.app_commands.describe(
@@ -719,14 +800,7 @@ async def manualtrip(
         except:
             pass
 
-    train_type = train.split(" ")[0]
-    train_line = train.split(" ")[1:]
-    train_no = ""
-    # if the last element in train_line starts with #, treat that as the train number
-    if train_line and train_line[-1].startswith("#"):
-        train_no = train_line[-1][1:]
-        train_line = train_line[0:-1]
-    train_line = " ".join(train_line)
+    train_type, train_line, train_no = parse_train(train)
 
     departure = parse_manual_time(departure, user.get_timezone())
     if (last_trip := DB.Trip.find_last_trip_for(user.discord_id)) and last_trip.status[
@@ -776,7 +850,7 @@ async def manualtrip(
             "type": train_type,
             "line": train_line,
             "no": train_no,
-            "id": "travelhookfaked" + random_id(),
+            "id": f"travelhookfaked{time.time_ns():x}{next(fake_trip_ids):x}",
             "hafasId": None,
         },
         "distance": distance,
@@ -791,23 +865,13 @@ async def manualtrip(
             [format_composition_element(unit.strip()) for unit in composition]
         )
     webhook = {"reason": "checkout", "status": status}
-    async with ClientSession() as session:
-        async with session.post(
-            "http://localhost:6005/travelynx",
-            json=webhook,
-            headers={"Authorization": f"Bearer {user.token_webhook}"},
-        ) as r:
-            await ia.edit_original_response(content=f"{r.status} {await r.text()}")
+    text = await process_webhook(user, webhook)
+    await ia.edit_original_response(content=text or "Nothing to publish.")
 
 
 def render_patched_train(trip, patch):
     "helper method to render a preview of how a train will look with a different patch applied"
-    status = json.loads(
-        DB.DB.execute(
-            "SELECT json_patch(?,?) as status",
-            (json.dumps(trip.get_unpatched_status()), json.dumps(patch)),
-        ).fetchone()["status"]
-    )
+    status = json_merge_patch(trip.get_unpatched_status(), patch)
     user_tz = DB.User.find(trip.user_id).get_timezone()
     display = get_display(bot, status)
     link = generate_train_link(status)
@@ -821,7 +885,7 @@ def render_patched_train(trip, patch):
         status["toStation"]["realTime"],
         timezone=user_tz,
     )
-    headsign = fetch_headsign(status)
+    headsign = trip.get_headsign(status)
     train_line = f"**{display['line']}**" if display["line"] else ""
     stations = f"\n{status['fromStation']['name']} {departure} → {status['toStation']['name']} {arrival}\n"
     if link:
@@ -870,20 +934,15 @@ class UndoView(discord.ui.View):
 
     @discord.ui.button(label="Yes, undo this trip.", style=discord.ButtonStyle.danger)
     async def doit(self, ia, _):
-        "once clicked, send a mocked undo checkin request to the webhook"
+        "once clicked, process a mocked undo checkin webhook"
         status = self.trip.get_unpatched_status()
         status["checkedIn"] = True
         DB.Trip.upsert(self.user.discord_id, status)
-        async with ClientSession() as session:
-            status["checkedIn"] = False
-            async with session.post(
-                "http://localhost:6005/travelynx",
-                json={"reason": "undo", "status": status},
-                headers={"Authorization": f"Bearer {self.user.token_webhook}"},
-            ) as r:
-                await ia.response.edit_message(
-                    content=f"{r.status} {await r.text()}", embed=None, view=None
-                )
+        status["checkedIn"] = False
+        text = await process_webhook(self.user, {"reason": "undo", "status": status})
+        await ia.response.edit_message(
+            content=text or "Nothing to undo.", embed=None, view=None
+        )
 
 
 @journey.command()
@@ -915,61 +974,64 @@ async def delay(ia, departure: typing.Optional[int], arrival: typing.Optional[in
             "realTime": trip.status["toStation"]["scheduledTime"] + arrival * 60
         }
 
-    newpatch = DB.DB.execute(
-        "SELECT json_patch(?,?) AS newpatch",
-        (json.dumps(trip.status_patch), json.dumps(prepare_patch)),
-    ).fetchone()["newpatch"]
-
-    trip.write_patch(json.loads(newpatch))
-    trip = DB.Trip.find(trip.user_id, trip.journey_id)
+    trip.write_patch(json_merge_patch(deepcopy(trip.status_patch), prepare_patch))
 
     reason = "update" if trip.status["checkedIn"] else "checkout"
-    async with ClientSession() as session:
-        async with session.post(
-            "http://localhost:6005/travelynx",
-            json={"reason": reason, "status": trip.get_unpatched_status()},
-            headers={"Authorization": f"Bearer {user.token_webhook}"},
-        ) as r:
-            if r.status == 200:
-                display = get_display(bot, trip.status)
-                link = generate_train_link(trip.status)
-                headsign = fetch_headsign(trip.get_unpatched_status())
-                train_line = f"**{display['line']}**" if display["line"] else ""
-                dep_delay = format_time(
-                    trip.status["fromStation"]["scheduledTime"],
-                    trip.status["fromStation"]["realTime"],
-                    timezone=user.get_timezone(),
-                )[8:-2]
-                arr_delay = format_time(
-                    trip.status["toStation"]["scheduledTime"],
-                    trip.status["toStation"]["realTime"],
-                    timezone=user.get_timezone(),
-                )[8:-2]
-
-                embed = discord.Embed(
-                    description=f"{display['emoji']} {train_line} **» {headsign}** "
-                    f"is delayed by **{dep_delay or '+0′'}/{arr_delay or '+0′'}**.",
-                    color=train_type_color["SB"],
-                ).set_author(
-                    name=f"{ia.user.name} ist {'nicht ' if len(dep_delay+arr_delay) == 0 else ''}verspätet",
-                    icon_url=ia.user.avatar.url,
-                )
+    webhook = {"reason": reason, "status": trip.get_unpatched_status()}
+    server = DB.Server.find(ia.guild.id)
+    live_channel = server.live_channel if server else None
+    live_msg = None
+    if live_channel and (
+        msg := DB.Message.find(trip.user_id, trip.journey_id, live_channel)
+    ):
+        # fetch the live message for the link while the webhook is being processed
+        text, live_msg = await asyncio.gather(
+            process_webhook(user, webhook), msg.fetch(bot), return_exceptions=True
+        )
+        if isinstance(text, BaseException):
+            raise text
+        if isinstance(live_msg, BaseException):
+            print(f"couldn't fetch live message {msg.message_id}: {live_msg!r}")
+            live_msg = None
+    else:
+        text = await process_webhook(user, webhook)
+        # the webhook might just have posted it
+        if live_channel and (
+            msg := DB.Message.find(trip.user_id, trip.journey_id, live_channel)
+        ):
+            live_msg = await msg.fetch(bot)
+
+    if text is not None:
+        display = get_display(bot, trip.status)
+        link = generate_train_link(trip.status)
+        headsign = trip.get_headsign()
+        train_line = f"**{display['line']}**" if display["line"] else ""
+        dep_delay = format_time(
+            trip.status["fromStation"]["scheduledTime"],
+            trip.status["fromStation"]["realTime"],
+            timezone=user.get_timezone(),
+        )[8:-2]
+        arr_delay = format_time(
+            trip.status["toStation"]["scheduledTime"],
+            trip.status["toStation"]["realTime"],
+            timezone=user.get_timezone(),
+        )[8:-2]
 
-                server = DB.Server.find(ia.guild.id)
-                if server.live_channel and (
-                    msg := DB.Message.find(
-                        trip.user_id, trip.journey_id, server.live_channel
-                    )
-                ):
-                    embed.description += (
-                        f"\n**current journey:** {(await msg.fetch(bot)).jump_url}"
-                    )
+        embed = discord.Embed(
+            description=f"{display['emoji']} {train_line} **» {headsign}** "
+            f"is delayed by **{dep_delay or '+0′'}/{arr_delay or '+0′'}**.",
+            color=train_type_color["SB"],
+        ).set_author(
+            name=f"{ia.user.name} ist {'nicht ' if len(dep_delay+arr_delay) == 0 else ''}verspätet",
+            icon_url=ia.user.avatar.url,
+        )
 
-                await ia.edit_original_response(content=None, embed=embed)
-            else:
-                await ia.edit_original_response(
-                    content=f"{r.status} {await r.text()}",
-                )
+        if live_msg:
+            embed.description += f"\n**current journey:** {live_msg.jump_url}"
+
+        await ia.edit_original_response(content=None, embed=embed)
+    else:
+        await ia.edit_original_response(content="Nothing to publish.")
 
 
 @journey.command()
@@ -999,42 +1061,34 @@ async def composition(ia, composition: str, do_not_format: bool = False):
             [format_composition_element(unit.strip()) for unit in composition]
         )
 
-    newpatch = DB.DB.execute(
-        "SELECT json_patch(?,?) AS newpatch",
-        (json.dumps(trip.status_patch), json.dumps(prepare_patch)),
-    ).fetchone()["newpatch"]
-    await EditTripView(trip, json.loads(newpatch)).commit.callback(ia)
+    newpatch = json_merge_patch(deepcopy(trip.status_patch), prepare_patch)
+    await EditTripView(trip, newpatch).commit.callback(ia)
 
 
 async def journey_autocomplete(ia, current):
-    def train_name(status, user):
+    def train_name(trip, user):
+        status = trip.status
         time = format_time(
             status["fromStation"]["scheduledTime"],
             status["fromStation"]["realTime"],
             timezone=user.get_timezone(),
         )[2:-2]
-        headsign = fetch_headsign(status)
-        if fhs := status["train"].get("fakeheadsign"):
-            headsign = fhs
-        return f"{time} {status['train']['type']} {status['train']['line'] or ''} » {headsign}"
+        return f"{time} {status['train']['type']} {status['train']['line'] or ''} » {trip.get_headsign()}"
 
     if user := DB.User.find(ia.user.id):
         return [
-            Choice(name=train_name(trip.status, user), value=trip.journey_id[-100:])
+            Choice(name=train_name(trip, user), value=trip.journey_id[-100:])
             for trip in DB.Trip.find_current_trips_for(user.discord_id)
         ][:24]
 
 
 async def network_autocomplete(ia, current):
-    networks = set(
-        [tt["network"] for tt in train_types_config["train_types"] if "network" in tt]
-    )
     networks = [
         Choice(
             name=f"[{network}] " + train_types_config["network_descriptions"][network],
             value=network,
         )
-        for network in networks
+        for network in known_networks
         if current.casefold() in network.casefold()
         or current.casefold() in train_types_config["network_descriptions"][network]
     ]
@@ -1089,54 +1143,50 @@ async def edit(
     if from_station or departure or departure_delay:
         prepare_patch["fromStation"] = {"name": from_station}
         if departure:
-            departure = parse_manual_time(departure, user.get_timezone())
-            prepare_patch["fromStation"]["scheduledTime"] = int(departure.timestamp())
+            departure = int(
+                parse_manual_time(departure, user.get_timezone()).timestamp()
+            )
+            prepare_patch["fromStation"]["scheduledTime"] = departure
             departure_delay = departure_delay or 0
         else:
-            departure = datetime.fromtimestamp(
-                trip.status["fromStation"]["scheduledTime"], tz=user.get_timezone()
-            )
+            departure = trip.status["fromStation"]["scheduledTime"]
 
         if departure_delay is not None:
-            prepare_patch["fromStation"]["realTime"] = int(departure.timestamp()) + (
-                (departure_delay or 0) * 60
+            prepare_patch["fromStation"]["realTime"] = (
+                departure + (departure_delay or 0) * 60
             )
 
     if to_station or arrival or arrival_delay:
         prepare_patch["toStation"] = {"name": to_station}
         if arrival:
-            arrival = parse_manual_time(arrival, user.get_timezone())
-            prepare_patch["toStation"]["scheduledTime"] = int(arrival.timestamp())
+            arrival = int(parse_manual_time(arrival, user.get_timezone()).timestamp())
+            prepare_patch["toStation"]["scheduledTime"] = arrival
             arrival_delay = arrival_delay or 0
         else:
-            arrival = datetime.fromtimestamp(
-                trip.status["toStation"]["scheduledTime"], tz=user.get_timezone()
-            )
+            arrival = trip.status["toStation"]["scheduledTime"]
 
         if arrival_delay is not None:
-            prepare_patch["toStation"]["realTime"] = int(arrival.timestamp()) + (
-                (arrival_delay or 0) * 60
-            )
+            prepare_patch["toStation"]["realTime"] = arrival + (arrival_delay or 0) * 60
 
     if train or headsign:
         prepare_patch["train"] = {
             "fakeheadsign": headsign,
         }
         if train:
-            train_type = train.split(" ")[0]
-            train_line = train.split(" ")[1:]
-            train_no = ""
-            # if the last element in train_line starts with #, treat that as the train number
-            if train_line and train_line[-1].startswith("#"):
-                train_no = train_line[-1][1:]
-                train_line = train_line[0:-1]
-            train_line = " ".join(train_line)
-
+            train_type, train_line, train_no = parse_train(train)
             prepare_patch["train"]["type"] = train_type
             prepare_patch["train"]["line"] = train_line
             if train_no:
                 prepare_patch["train"]["no"] = train_no
 
+    # options that weren't given are None, which would delete earlier edits to them
+    # in the merge patch instead of leaving them alone. drop them before merging
+    for key in ("fromStation", "toStation", "train"):
+        if key in prepare_patch:
+            prepare_patch[key] = {
+                k: v for k, v in prepare_patch[key].items() if v is not None
+            }
+
     if comment:
         prepare_patch["comment"] = comment
     if distance:
@@ -1155,17 +1205,7 @@ async def edit(
             [format_composition_element(unit.strip()) for unit in composition]
         )
 
-    newpatch = DB.DB.execute(
-        "SELECT json_patch(?,?) AS newpatch",
-        (json.dumps(trip.status_patch), json.dumps(prepare_patch)),
-    ).fetchone()["newpatch"]
-
-    newpatched_status = DB.DB.execute(
-        "SELECT json_patch(?,?) as newpatched_status", (trip.travelynx_status, newpatch)
-    ).fetchone()["newpatched_status"]
-
-    newpatch = json.loads(newpatch)
-    newpatched_status = json.loads(newpatched_status)
+    newpatch = json_merge_patch(deepcopy(trip.status_patch), prepare_patch)
 
     await ia.edit_original_response(
         embed=discord.Embed(
@@ -1191,40 +1231,51 @@ class EditTripView(discord.ui.View):
 
     def __init__(self, trip, newpatch):
         self.trip = trip
+        # we need this for committing, no need to look it up again then
+        self.user = DB.User.find(trip.user_id)
         self.newpatch = newpatch
-        self.modal = self.EnterStatusPatchModal(self, self.trip, self.newpatch)
+        self.newpatch_toml = None
+        self._modal = None
         super().__init__()
 
-    def attachnewmodal(self, newpatch):
-        """so for some reason we can't reuse the editor modal, so we create a new
-        one with the same data every time the editor is closed"""
+    @property
+    def modal(self):
+        """the editor modal. most people just commit, so only build it (and render the patch
+        to toml) once someone actually wants to open the editor"""
+        if self._modal is None:
+            if self.newpatch_toml is None:
+                self.newpatch_toml = tomli_w.dumps(self.newpatch)
+            self._modal = self.EnterStatusPatchModal(
+                self, self.trip, self.newpatch, self.newpatch_toml
+            )
+        return self._modal
+
+    def attachnewmodal(self, newpatch, newpatch_toml=None):
+        """so for some reason we can't reuse the editor modal (discord.py stops it once it's
+        submitted), so we drop it and the next click on edit creates a new one with the new data.
+        the toml for it is only rendered again if we don't already have it for this exact patch
+        """
+        if newpatch_toml is not None:
+            self.newpatch_toml = newpatch_toml
+        elif newpatch is not self.newpatch:
+            self.newpatch_toml = None
         self.newpatch = newpatch
-        self.modal = self.EnterStatusPatchModal(self, self.trip, self.newpatch)
+        self._modal = None
 
     @discord.ui.button(label="Commit my edits now.", style=discord.ButtonStyle.green)
     async def commit(self, ia, _):
-        "write newpatch into the database and issue a mocked update webhook"
+        "write newpatch into the database and process a mocked update webhook"
+        # processing the webhook edits every live message, don't let the interaction time out on that
+        if not ia.response.is_done():
+            await ia.response.defer()
         self.trip.write_patch(self.newpatch)
-        self.trip = DB.Trip.find(
-            self.trip.user_id, self.trip.journey_id
-        )  # update, just in case
         reason = "update" if self.trip.status["checkedIn"] else "checkout"
-        async with ClientSession() as session:
-            async with session.post(
-                "http://localhost:6005/travelynx",
-                json={"reason": reason, "status": self.trip.get_unpatched_status()},
-                headers={
-                    "Authorization": f"Bearer {DB.User.find(self.trip.user_id).token_webhook}"
-                },
-            ) as r:
-                if ia.response.is_done():
-                    await ia.edit_original_response(
-                        content=f"{r.status} {await r.text()}", embed=None, view=None
-                    )
-                else:
-                    await ia.response.edit_message(
-                        content=f"{r.status} {await r.text()}", embed=None, view=None
-                    )
+        text = await process_webhook(
+            self.user, {"reason": reason, "status": self.trip.get_unpatched_status()}
+        )
+        await ia.edit_original_response(
+            content=text or "Nothing to publish.", embed=None, view=None
+        )
 
     @discord.ui.button(
         label="Open the manual editor instead.", style=discord.ButtonStyle.grey
@@ -1242,17 +1293,17 @@ class EditTripView(discord.ui.View):
             required=False,
         )
 
-        def __init__(self, parent, trip, newpatch):
+        def __init__(self, parent, trip, newpatch, newpatch_toml):
             self.parent = parent
             self.trip = trip
             self.newpatch = newpatch
-            self.patch_input.default = tomli_w.dumps(newpatch)  # wow much efficiency
+            self.patch_input.default = newpatch_toml
             super().__init__()
 
         async def on_submit(self, ia):
             self.newpatch = tomli.loads(self.patch_input.value)
-            self.patch_input.default = tomli_w.dumps(self.newpatch)
-            self.parent.attachnewmodal(self.newpatch)
+            # what the user just typed is valid toml for the new patch, no need to render it again
+            self.parent.attachnewmodal(self.newpatch, self.patch_input.value)
             await ia.response.edit_message(
                 embed=discord.Embed(
                     description="Current state:\n"
@@ -1334,12 +1385,30 @@ def explain_display(bot, tt, for_variants=False):
         return f"`{type:>6}` {emoji(bot, tt)}{variant_indicator}"
 
 
-@manual.command()
-async def train_types(ia):
-    "list the train types the relay bot knows about"
+def cache_when_complete(build):
+    """like functools.cache for the manual embeds, but don't keep one that still has
+    FIXME placeholders because the emoji servers weren't loaded yet"""
+    cached = None
+
+    @functools.wraps(build)
+    def wrapper():
+        nonlocal cached
+        if cached:
+            return cached
+        embed = build()
+        if not "FIXME" in str(embed):
+            cached = embed
+        return embed
+
+    return wrapper
+
+
+@cache_when_complete
+def train_types_embed():
+    "the train types manual only depends on the config, so we build it once and keep its dict around"
     train_types = train_types_config["train_types"]
     embed = discord.Embed(
-        color=discord.Color.from_str("#2e2e7d"),
+        color=0x2E2E7D,
         title="manual: train types",
         description=f"the relay bot currently knows **{len(set([tt.get('type') for tt in train_types]))} "
         "train types**. when you use a supported type of transport, the bot will display a hand-crafted special icon for it!\n"
@@ -1363,16 +1432,20 @@ async def train_types(ia):
             value="\n".join([explain_display(bot, tt) for tt in tts])
             + (fallback_description if key == "special" else ""),
         )
-
-    await ia.response.send_message(embed=embed)
+    return embed.to_dict()
 
 
 @manual.command()
-async def train_variants(ia):
-    "list the train display variants for transit networks the bot knows about"
+async def train_types(ia):
+    "list the train types the relay bot knows about"
+    await ia.response.send_message(embed=discord.Embed.from_dict(train_types_embed()))
+
 
+@cache_when_complete
+def train_variants_embed():
+    "same as train_types_embed, this never changes while we're running"
     embed = discord.Embed(
-        color=discord.Color.from_str("#2e2e7d"),
+        color=0x2E2E7D,
         title="manual: train display variants",
         description="the relay bot supports 'native' display variants for a number of transit "
         "networks. when you check in with travelynx or **/scotty**, the bot will automatically "
@@ -1398,7 +1471,15 @@ async def train_variants(ia):
                     [explain_display(bot, tt, for_variants=True) for tt in types]
                 )
             )
-    await ia.response.send_message(embed=embed)
+    return embed.to_dict()
+
+
+@manual.command()
+async def train_variants(ia):
+    "list the train display variants for transit networks the bot knows about"
+    await ia.response.send_message(
+        embed=discord.Embed.from_dict(train_variants_embed())
+    )
 
 
 bot.tree.add_command(manual, guilds=servers)
@@ -1443,7 +1524,7 @@ class RegisterTravelynxStepZero(discord.ui.View):
     )
     async def doit(self, ia, _):
         "button to proceed to step 1"
-        if DB.User.find(discord_id=ia.user.id):
+        if DB.User.exists(ia.user.id):
             await ia.response.send_message(
                 embed=discord.Embed(
                     title="Oops!",
@@ -1490,6 +1571,8 @@ class RegisterTravelynxStepOne(discord.ui.View):
             """triggered on modal submit, if everything is fine, register the user and
             edit ephemeral response to proceed to step 2, else ask them to try again"""
             token = self.token.value.strip()
+            # checking the token asks travelynx, which might take longer than discord waits for us
+            await ia.response.defer()
             if await is_token_valid(token):
                 DB.User(
                     discord_id=ia.user.id,
@@ -1501,7 +1584,7 @@ class RegisterTravelynxStepOne(discord.ui.View):
                     show_train_numbers=False,
                     timezone="Europe/Berlin",
                 ).write()
-                await ia.response.edit_message(
+                await ia.edit_original_response(
                     embed=discord.Embed(
                         title="Step 2/3: Connect Live Feed (optional)",
                         color=train_type_color["SB"],
@@ -1514,7 +1597,7 @@ class RegisterTravelynxStepOne(discord.ui.View):
                     view=RegisterTravelynxStepTwo(),
                 )
             else:
-                await ia.response.edit_message(
+                await ia.edit_original_response(
                     embed=discord.Embed(
                         title="Step 1/3: Connect Status API",
                         color=train_type_color["U1"],
@@ -1728,30 +1811,29 @@ async def cts_stationboard(logicalstopcode, request_time):
         if str(sb_params) in shitty_cts_cache:
             resp = deepcopy(shitty_cts_cache[str(sb_params)][1])
         else:
-            async with ClientSession() as session:
-                async with session.get(
-                    "https://api.cts-strasbourg.eu/v1/siri/2.0/stop-monitoring",
-                    params=sb_params,
-                    headers=sb_headers,
-                ) as r:
-                    if r.status != 200:
-                        print(f"cts stationboard returned {r.status}: {await r.text()}")
-                        return []
-                    try:
-                        resp = await r.json()
-                        resp_validuntil = datetime.fromisoformat(
-                            resp["ServiceDelivery"]["StopMonitoringDelivery"][0][
-                                "ValidUntil"
-                            ]
-                        )
-                        shitty_cts_cache[str(sb_params)] = (
-                            resp_validuntil,
-                            deepcopy(resp),
-                        )
-                    except:  # pylint: disable=bare-except
-                        print("error while decoding:")
-                        traceback.print_exc()
-                        print(await r.text())
+            async with get_http_session().get(
+                "https://api.cts-strasbourg.eu/v1/siri/2.0/stop-monitoring",
+                params=sb_params,
+                headers=sb_headers,
+            ) as r:
+                if r.status != 200:
+                    print(f"cts stationboard returned {r.status}: {await r.text()}")
+                    return []
+                try:
+                    resp = await r.json()
+                    resp_validuntil = datetime.fromisoformat(
+                        resp["ServiceDelivery"]["StopMonitoringDelivery"][0][
+                            "ValidUntil"
+                        ]
+                    )
+                    shitty_cts_cache[str(sb_params)] = (
+                        resp_validuntil,
+                        deepcopy(resp),
+                    )
+                except:  # pylint: disable=bare-except
+                    print("error while decoding:")
+                    traceback.print_exc()
+                    print(await r.text())
 
         if (
             not "MonitoredStopVisit"
@@ -1801,30 +1883,29 @@ async def cts_journey(selected_transport):
         if str(j_params) in shitty_cts_cache:
             resp = deepcopy(shitty_cts_cache[str(j_params)][1])
         else:
-            async with ClientSession() as session:
-                async with session.get(
-                    "https://api.cts-strasbourg.eu/v1/siri/2.0/estimated-timetable",
-                    params=j_params,
-                    headers=j_headers,
-                ) as r:
-                    if r.status != 200:
-                        print(f"cts timetable returned {r.status}: {await r.text()}")
-                        return []
-                    try:
-                        resp = await r.json()
-                        resp_validuntil = datetime.fromisoformat(
-                            resp["ServiceDelivery"]["EstimatedTimetableDelivery"][0][
-                                "ValidUntil"
-                            ]
-                        )
-                        shitty_cts_cache[str(j_params)] = (
-                            resp_validuntil,
-                            deepcopy(resp),
-                        )
-                    except:  # pylint: disable=bare-except
-                        print("error while decoding:")
-                        traceback.print_exc()
-                        print(await r.text())
+            async with get_http_session().get(
+                "https://api.cts-strasbourg.eu/v1/siri/2.0/estimated-timetable",
+                params=j_params,
+                headers=j_headers,
+            ) as r:
+                if r.status != 200:
+                    print(f"cts timetable returned {r.status}: {await r.text()}")
+                    return []
+                try:
+                    resp = await r.json()
+                    resp_validuntil = datetime.fromisoformat(
+                        resp["ServiceDelivery"]["EstimatedTimetableDelivery"][0][
+                            "ValidUntil"
+                        ]
+                    )
+                    shitty_cts_cache[str(j_params)] = (
+                        resp_validuntil,
+                        deepcopy(resp),
+                    )
+                except:  # pylint: disable=bare-except
+                    print("error while decoding:")
+                    traceback.print_exc()
+                    print(await r.text())
 
         journeys = resp["ServiceDelivery"]["EstimatedTimetableDelivery"][0][
             "EstimatedJourneyVersionFrame"
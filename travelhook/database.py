@@ -2,7 +2,10 @@
 "contains and encapsulates database accesses"
 import asyncio
 import collections
-import json
+import contextlib
+import contextvars
+import functools
+import itertools
 import sqlite3
 import shlex
 import subprocess
@@ -14,27 +17,106 @@ from typing import Optional
 from zoneinfo import ZoneInfo
 
 import discord
+import orjson
 from pyhafas.types.fptf import Stopover
 
 from .helpers import (
     zugid,
-    hafas,
+    hafas_trip,
     tz,
     random_id,
-    replace_headsign,
+    replace_headsign_by_line,
     format_composition_element,
+    json_merge_patch,
     db_replace_group_classes,
     describe_class,
 )
 from . import oebb_wr
 
 DB = None
+# read-only connection for the static reference tables (cities, stops, stations)
+RO = None
+
+# set to a fresh dict by the webhook handler. while set, finders decorated with
+# cached_per_request return the result of the first identical call in the same request.
+request_cache = contextvars.ContextVar("req_cache", default=None)
+
+# every write to a trip takes its new revision from here. it only ever counts up, so a trip
+# that was deleted and inserted again can't get a revision an old copy of it still has
+trip_revisions = None
+
+
+def next_trip_revision():
+    return next(trip_revisions)
 
 
 def connect(path):
-    global DB
-    DB = sqlite3.connect(path, isolation_level=None)
+    global DB, RO, trip_revisions
+    # sqlite3 keeps prepared statements per sql text, give it room for all of ours
+    DB = sqlite3.connect(path, isolation_level=None, cached_statements=512)
     DB.row_factory = sqlite3.Row
+    # WAL lets reads continue while we write and only needs one fsync per commit,
+    # synchronous=NORMAL is still safe against corruption in WAL mode
+    DB.execute("PRAGMA journal_mode=WAL")
+    DB.execute("PRAGMA synchronous=NORMAL")
+    DB.execute("PRAGMA busy_timeout=5000")
+    DB.execute("PRAGMA temp_store=MEMORY")
+    DB.execute("PRAGMA cache_size=-20000")
+    DB.execute("PRAGMA mmap_size=268435456")
+    DB.execute("PRAGMA foreign_keys=ON")
+
+    RO = sqlite3.connect(f"file:{path}?mode=ro", uri=True, cached_statements=512)
+    RO.row_factory = sqlite3.Row
+
+    trip_revisions = itertools.count(
+        DB.execute("SELECT coalesce(max(revision), 0) + 1 FROM trips").fetchone()[0]
+    )
+
+
+async def run_helper(*args):
+    """run one of our perl helper scripts without blocking the event loop,
+    so other users' webhooks keep going while hafas takes its time. returns (stdout, stderr)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    return await proc.communicate()
+
+
+@contextlib.contextmanager
+def transaction():
+    """group writes into a single transaction, so they're committed with one fsync and
+    rolled back together on errors. don't await anything inside, other tasks share the connection
+    """
+    DB.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except:  # pylint: disable=bare-except
+        DB.execute("ROLLBACK")
+        raise
+    DB.execute("COMMIT")
+
+
+def cached_per_request(func):
+    "memoize a finder for the lifetime of the current request_cache, if there is one"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = request_cache.get()
+        if cache is None:
+            return func(*args, **kwargs)
+        key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = func(*args, **kwargs)
+        return cache[key]
+
+    return wrapper
+
+
+def invalidate_request_cache():
+    "drop everything cached in this request, call this after writing to the database"
+    if (cache := request_cache.get()) is not None:
+        cache.clear()
 
 
 @dataclass
@@ -88,6 +170,7 @@ class User:
     Locks = collections.defaultdict(asyncio.Lock)
 
     @classmethod
+    @cached_per_request
     def find(cls, discord_id=None, token_webhook=None):
         row = None
         if discord_id:
@@ -105,6 +188,16 @@ class User:
             return cls(**row)
         return None
 
+    @classmethod
+    def exists(cls, discord_id):
+        "check if someone is registered without loading their whole row"
+        return (
+            DB.execute(
+                "SELECT 1 FROM users WHERE discord_id = ? LIMIT 1", (discord_id,)
+            ).fetchone()
+            is not None
+        )
+
     def write(self):
         "insert the manually created user object into the database as a fresh registration"
         DB.execute(
@@ -180,7 +273,7 @@ class City:
 
     @classmethod
     def find(cls, name):
-        row = DB.execute(
+        row = RO.execute(
             "SELECT name FROM cities WHERE name = ?",
             (name,),
         ).fetchone()
@@ -197,18 +290,26 @@ class CTSStop:
 
     @classmethod
     def find_all(cls):
-        rows = DB.execute("SELECT * FROM cts_stops").fetchall()
+        rows = RO.execute("SELECT * FROM cts_stops").fetchall()
         return [cls(**row) for row in rows]
 
     @classmethod
     def find_by_logicalstopcode(cls, logicalstopcode):
-        row = DB.execute(
+        row = RO.execute(
             "SELECT name FROM cts_stops WHERE logicalstopcode = ?", (logicalstopcode,)
         ).fetchone()
         if row:
             return row["name"]
 
 
+# shared by all trip finders so they always fetch the same columns in the same order
+TRIP_COLUMNS = (
+    "journey_id, user_id, json_patch(travelynx_status, status_patch) as travelynx_status, "
+    "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data, revision"
+)
+TRIP_SELECT = f"SELECT {TRIP_COLUMNS} FROM trips "
+
+
 @dataclass
 class Trip:
     "user-trips the bot knows about"
@@ -226,18 +327,17 @@ class Trip:
     headsign: str
     status_patch: str
     hafas_data: str
+    revision: int
 
     def __post_init__(self):
-        self.status = json.loads(self.travelynx_status)
-        self.status_patch = json.loads(self.status_patch)
-        self.hafas_data = json.loads(self.hafas_data)
+        self.status = orjson.loads(self.travelynx_status)
+        self.status_patch = orjson.loads(self.status_patch)
+        self.hafas_data = orjson.loads(self.hafas_data)
 
     @classmethod
     def find(cls, user_id, journey_id):
         row = DB.execute(
-            "SELECT journey_id, user_id, json_patch(travelynx_status, status_patch) as travelynx_status, "
-            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data "
-            "FROM trips WHERE user_id = ? AND journey_id = ?",
+            TRIP_SELECT + "WHERE user_id = ? AND journey_id = ?",
             (user_id, journey_id),
         ).fetchone()
         if row:
@@ -245,16 +345,17 @@ class Trip:
         return None
 
     @classmethod
+    @cached_per_request
     def find_current_trips_for(cls, user_id):
         rows = DB.execute(
-            "SELECT journey_id, user_id, json_patch(travelynx_status, status_patch) as travelynx_status, "
-            "from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, headsign, status_patch, hafas_data "
-            "FROM trips WHERE user_id = ? ORDER BY json_patch(travelynx_status, status_patch) ->> '$.fromStation.realTime' ASC",
+            TRIP_SELECT
+            + "WHERE user_id = ? ORDER BY json_patch(travelynx_status, status_patch) ->> '$.fromStation.realTime' ASC",
             (user_id,),
         ).fetchall()
         return [cls(**row) for row in rows]
 
     @classmethod
+    @cached_per_request
     def find_last_trip_for(cls, user_id):
         if current_trips := cls.find_current_trips_for(user_id):
             return current_trips[-1]
@@ -262,15 +363,18 @@ class Trip:
 
     @classmethod
     def upsert(cls, userid, status):
-        DB.execute(
-            "INSERT INTO trips(journey_id, user_id, travelynx_status, from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon) "
-            "VALUES(?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT DO UPDATE SET travelynx_status=excluded.travelynx_status, "
+        "insert or update the trip for this status, returns it like Trip.find would"
+        rows = DB.execute(
+            "INSERT INTO trips(journey_id, user_id, travelynx_status, from_time, from_station, from_lat, from_lon, to_time, to_station, to_lat, to_lon, revision) "
+            "VALUES(?,?,?,?,?,?,?,?,?,?,?,?) ON CONFLICT DO UPDATE SET travelynx_status=excluded.travelynx_status, "
             "from_time = excluded.from_time, from_station=excluded.from_station, from_lat=excluded.from_lat, from_lon=excluded.from_lon, "
-            "to_time = excluded.to_time, to_station=excluded.to_station, to_lat=excluded.to_lat, to_lon=excluded.to_lon",
+            "to_time = excluded.to_time, to_station=excluded.to_station, to_lat=excluded.to_lat, to_lon=excluded.to_lon, "
+            "revision = excluded.revision "
+            f"RETURNING {TRIP_COLUMNS}",
             (
                 zugid(status),
                 userid,
-                json.dumps(status),
+                orjson.dumps(status).decode(),
                 status["fromStation"]["realTime"],
                 status["fromStation"]["name"],
                 status["fromStation"]["latitude"],
@@ -279,33 +383,62 @@ class Trip:
                 status["toStation"]["name"],
                 status["toStation"]["latitude"],
                 status["toStation"]["longitude"],
+                next_trip_revision(),
             ),
-        )
+        ).fetchall()  # step it to completion so the write is done
+        return cls(**rows[0])
 
     def delete(self):
         DB.execute(
             "DELETE FROM trips WHERE user_id = ? AND journey_id = ?",
-            (self.user_id, zugid(self.status)),
+            (self.user_id, self.journey_id),
         )
 
     def write_patch(self, status_patch):
-        "write the status patch field to the database"
-        DB.execute(
-            "UPDATE trips SET status_patch=? WHERE user_id = ? AND journey_id = ?",
-            (json.dumps(status_patch), self.user_id, self.journey_id),
-        )
+        "write the status patch field to the database and update this trip to match"
+        rows = DB.execute(
+            "UPDATE trips SET status_patch=?, revision = ? WHERE user_id = ? AND journey_id = ? "
+            "RETURNING json_patch(travelynx_status, status_patch) AS travelynx_status, revision",
+            (
+                orjson.dumps(status_patch).decode(),
+                next_trip_revision(),
+                self.user_id,
+                self.journey_id,
+            ),
+        ).fetchall()
+        self.status_patch = status_patch
+        if rows:
+            self.travelynx_status = rows[0]["travelynx_status"]
+            self.status = orjson.loads(self.travelynx_status)
+            self.revision = rows[0]["revision"]
+
+    def is_current(self):
+        "check if the trip hasn't been written to since we fetched it"
+        row = DB.execute(
+            "SELECT revision FROM trips WHERE user_id = ? AND journey_id = ?",
+            (self.user_id, self.journey_id),
+        ).fetchone()
+        return row and row["revision"] == self.revision
+
+    def reload_if_stale(self):
+        """reload the trip if something else, like /delay or the editor, wrote to it
+        while we were awaiting. call it before building a new patch from ours"""
+        if not self.is_current() and (
+            fresh := Trip.find(self.user_id, self.journey_id)
+        ):
+            vars(self).update(vars(fresh))
 
     def get_unpatched_status(self):
         """get the unpatched status, for mocking webhooks. this way we don't
         accidentally destructively commit the user's edits as the actual status."""
-        return json.loads(
+        return orjson.loads(
             DB.execute(
                 "SELECT travelynx_status FROM trips WHERE user_id = ? AND journey_id = ?",
                 (self.user_id, self.journey_id),
             ).fetchone()["travelynx_status"]
         )
 
-    def maybe_fix_1970(self):
+    async def maybe_fix_1970(self):
         """sometimes the toStation times wind up being unix time 0 instead of the actual time,
         we can fix that."""
 
@@ -320,9 +453,10 @@ class Trip:
             return
 
         try:
-            this_trip = hafas.trip(
+            this_trip = await hafas_trip(
                 self.status["train"]["hafasId"] or self.status["train"]["id"]
             )
+            self.reload_if_stale()
             stops = [
                 Stopover(
                     stop=this_trip.destination,
@@ -351,7 +485,7 @@ class Trip:
             print("error while running 1970 fixup:")
             traceback.print_exc()
 
-    def maybe_fix_circle_line(self):
+    async def maybe_fix_circle_line(self):
         """if we're on a line that visits the same stop more than once, we might be logged on
         the first time the stop is visited. if we can detect this, skip to the first stop that wouldn't
         make the journey have time skips in it."""
@@ -372,82 +506,74 @@ class Trip:
         print("this sure smells like a erlangen type situation", dict(trip))
 
         try:
-            this_trip = hafas.trip(
+            this_trip = await hafas_trip(
                 self.status["train"]["hafasId"] or self.status["train"]["id"]
             )
-            stops = []
-            if this_trip.stopovers:
-                stops += this_trip.stopovers
-
-            stops = [
-                stop
-                for stop in stops
-                if stop.stop.id == str(self.status["fromStation"]["uic"])
-                and stop.departure
-                and (stop.departure + (stop.departureDelay or timedelta()))
-                >= datetime.fromtimestamp(trip["arrival"], tz=tz)
-            ]
-            if stops:
+            self.reload_if_stale()
+            stopovers = this_trip.stopovers or []
+            from_uic = str(self.status["fromStation"]["uic"])
+            earliest_departure = datetime.fromtimestamp(trip["arrival"], tz=tz)
+            first_stop = next(
+                (
+                    stop
+                    for stop in stopovers
+                    if stop.stop.id == from_uic
+                    and stop.departure
+                    and (stop.departure + (stop.departureDelay or timedelta()))
+                    >= earliest_departure
+                ),
+                None,
+            )
+            if first_stop:
                 print(
-                    f"found some! original {self.status['fromStation']} my best guess {stops[0]}"
+                    f"found some! original {self.status['fromStation']} my best guess {first_stop}"
                 )
-                departure_ts = int(stops[0].departure.timestamp())
+                departure_ts = int(first_stop.departure.timestamp())
                 first_station_patch = {
                     "fromStation": {
                         "scheduledTime": departure_ts,
-                        "realTime": int(stops[0].departure.timestamp())
-                        + int((stops[0].departureDelay or timedelta()).total_seconds()),
+                        "realTime": departure_ts
+                        + int(
+                            (first_stop.departureDelay or timedelta()).total_seconds()
+                        ),
                     }
                 }
-                if (
-                    stops[0].departure.timestamp()
-                    > self.status["toStation"]["scheduledTime"]
-                ):
-                    destination = this_trip.stopovers + [
-                        Stopover(
-                            stop=this_trip.destination,
-                            arrival=this_trip.arrival,
-                            arrival_delay=this_trip.arrivalDelay,
-                        )
-                    ]
-                    print(
-                        [
-                            d
-                            for d in destination
-                            if d.arrival and d.arrival > stops[0].departure
-                        ]
-                    )
-                    destination = [
+                if departure_ts > self.status["toStation"]["scheduledTime"]:
+                    later_stops = [
                         stop
-                        for stop in destination
-                        if stop.stop.id == str(self.status["toStation"]["uic"])
-                        and stop.arrival
-                        and stop.arrival > stops[0].departure
+                        for stop in stopovers
+                        + [
+                            Stopover(
+                                stop=this_trip.destination,
+                                arrival=this_trip.arrival,
+                                arrival_delay=this_trip.arrivalDelay,
+                            )
+                        ]
+                        if stop.arrival and stop.arrival > first_stop.departure
                     ]
-                    if destination:
-                        arrival_ts = int(destination[0].arrival.timestamp())
+                    print(later_stops)
+                    to_uic = str(self.status["toStation"]["uic"])
+                    if destination := next(
+                        (stop for stop in later_stops if stop.stop.id == to_uic), None
+                    ):
+                        arrival_ts = int(destination.arrival.timestamp())
                         first_station_patch["toStation"] = {
                             "scheduledTime": arrival_ts,
                             "realTime": arrival_ts
                             + int(
                                 (
-                                    destination[0].arrivalDelay or timedelta()
+                                    destination.arrivalDelay or timedelta()
                                 ).total_seconds()
                             ),
                         }
-                newpatch = DB.execute(
-                    "SELECT json_patch(?,?) AS newpatch",
-                    (
-                        json.dumps(first_station_patch),
-                        json.dumps(self.status_patch),
-                    ),
-                ).fetchone()["newpatch"]
-                self.write_patch(json.loads(newpatch))
+                self.write_patch(
+                    json_merge_patch(first_station_patch, self.status_patch)
+                )
         except:  # pylint: disable=bare-except
             print("error while running circle line fixup:")
             traceback.print_exc()
 
-    def fetch_hafas_data(self, force: bool = False):
+    async def fetch_hafas_data(self, force: bool = False):
         "perform arcane magick (perl 'FFI') to get hafas data for our trip"
 
         backend = self.status["backend"]["name"]
@@ -460,17 +586,16 @@ class Trip:
         elif backend == "manual":
             return
 
-        def write_hafas_data(departureboard_entry):
-            hafas = subprocess.run(
-                ["json-hafas.pl", backend, departureboard_entry["id"]],
-                capture_output=True,
+        async def write_hafas_data(departureboard_entry):
+            stdout, stderr = await run_helper(
+                "json-hafas.pl", backend, departureboard_entry["id"]
             )
-            status = {}
             try:
-                status = json.loads(hafas.stdout)
-            except:  # pylint: disable=bare-except
-                print(f"hafas perl broke:\n{hafas.stdout} {hafas.stderr}")
-                traceback.print_exc()
+                status = orjson.loads(stdout)
+            except orjson.JSONDecodeError:
+                print(f"hafas perl broke:\n{stdout} {stderr}")
+                return
+            self.reload_if_stale()
 
             if "error_code" in status:
                 print(f"hafas perl broke:\n{status}")
@@ -481,21 +606,25 @@ class Trip:
                     headsign = status["route"][-1]["name"]
                 if hs := self.maybe_fix_rnv_5(headsign):
                     headsign = hs
-                train_key = (
-                    (
-                        self.status["train"]["type"].strip()
-                        + (
-                            self.status["train"]["line"] or self.status["train"]["no"]
-                        ).strip()
-                    ),
-                    headsign,
+                line_key = (
+                    self.status["train"]["type"].strip()
+                    + (
+                        self.status["train"]["line"] or self.status["train"]["no"]
+                    ).strip()
                 )
-                headsign = replace_headsign.get(train_key, headsign) or "?"
+                if replacements := replace_headsign_by_line.get(line_key):
+                    headsign = replacements.get(headsign, headsign)
+                # store NULL rather than a "?" placeholder, that would look like a real headsign
+                # to fetch_headsign. displaying falls back to "?" by itself
+                headsign = headsign or None
+                self.headsign = headsign
+                self.revision = next_trip_revision()
                 DB.execute(
-                    "UPDATE trips SET hafas_data=?, headsign=? WHERE user_id = ? AND journey_id = ?",
+                    "UPDATE trips SET hafas_data=?, headsign=?, revision = ? WHERE user_id = ? AND journey_id = ?",
                     (
-                        json.dumps(status),
+                        orjson.dumps(status).decode(),
                         headsign,
+                        self.revision,
                         self.user_id,
                         self.journey_id,
                     ),
@@ -510,21 +639,17 @@ class Trip:
         if not jid and "|" in self.status["train"]["id"]:
             jid = self.status["train"]["id"]
 
-        hafas_sb = subprocess.run(
-            [
-                "json-hafas-stationboard.pl",
-                backend,
-                str(self.status["fromStation"]["uic"]),
-                str(self.status["fromStation"]["scheduledTime"]),
-            ],
-            capture_output=True,
+        sb_stdout, sb_stderr = await run_helper(
+            "json-hafas-stationboard.pl",
+            backend,
+            str(self.status["fromStation"]["uic"]),
+            str(self.status["fromStation"]["scheduledTime"]),
         )
         stationboard = {}
         try:
-            stationboard = json.loads(hafas_sb.stdout)
-        except:  # pylint: disable=bare-except
-            print(f"hafas sb perl broke:\n{hafas_sb.stdout} {hafas_sb.stderr}")
-            traceback.print_exc()
+            stationboard = orjson.loads(sb_stdout)
+        except orjson.JSONDecodeError:
+            print(f"hafas sb perl broke:\n{sb_stdout} {sb_stderr}")
             return
         if "error_code" in stationboard:
             print(f"hafas sb perl broke:\n{stationboard}")
@@ -534,19 +659,25 @@ class Trip:
             if not train["scheduled"] == self.status["fromStation"]["scheduledTime"]:
                 continue
             if jid == train["id"] or (train["number"] == self.status["train"]["no"]):
-                write_hafas_data(train)
+                await write_hafas_data(train)
                 break
         else:
             print("didn't find a match!")
 
-    def fetch_headsign(self):
+    async def fetch_headsign(self):
         if headsign := (self.headsign or self.status["train"].get("fakeheadsign")):
             return headsign
 
         if not self.hafas_data:
-            self.fetch_hafas_data()
+            await self.fetch_hafas_data()
         return self.headsign or "?"
 
+    def get_headsign(self, status=None):
+        """the headsign to display for this trip (or a preview status of it),
+        from what we already loaded without asking the database or hafas again"""
+        status = status or self.status
+        return status["train"].get("fakeheadsign") or self.headsign or "?"
+
     def maybe_fix_rnv_5(self, headsign):
         "try to detect which way the line 5 in mannheim is going"
         if not (
@@ -576,7 +707,7 @@ class Trip:
             # mannheim→heidelberg
             return f"{headsign} ↺"
 
-    def get_db_composition(self):
+    async def get_db_composition(self):
         if "composition" in self.status:
             return
         if not self.status["train"]["no"]:
@@ -586,22 +717,18 @@ class Trip:
         ):
             return
 
-        db_wr = subprocess.run(
-            [
-                "json-db-composition.pl",
-                str(self.status["fromStation"]["scheduledTime"]),
-                str(self.status["fromStation"]["uic"]),
-                self.status["train"]["type"],
-                self.status["train"]["no"],
-            ],
-            capture_output=True,
+        wr_stdout, wr_stderr = await run_helper(
+            "json-db-composition.pl",
+            str(self.status["fromStation"]["scheduledTime"]),
+            str(self.status["fromStation"]["uic"]),
+            self.status["train"]["type"],
+            self.status["train"]["no"],
         )
-        status = {}
         try:
-            status = json.loads(db_wr.stdout)
-        except:  # pylint: disable=bare-except
-            print(f"db_wr perl broke:\n{db_wr.stdout} {db_wr.stderr}")
-            traceback.print_exc()
+            status = orjson.loads(wr_stdout)
+        except orjson.JSONDecodeError:
+            print(f"db_wr perl broke:\n{wr_stdout} {wr_stderr}")
+            return
 
         if "error_string" in status:
             print(f"db_wr perl broke:\n{status}")
@@ -664,14 +791,11 @@ class Trip:
             composition_text = " + ".join(
                 [format_composition_element(unit) for unit in composition]
             )
-            newpatch = DB.execute(
-                "SELECT json_patch(?,?) AS newpatch",
-                (
-                    json.dumps({"composition": composition_text}),
-                    json.dumps(self.status_patch),
-                ),
-            ).fetchone()["newpatch"]
-            self.write_patch(json.loads(newpatch))
+            # the user's own edits win over whatever we fetched
+            self.reload_if_stale()
+            self.write_patch(
+                json_merge_patch({"composition": composition_text}, self.status_patch)
+            )
 
     async def get_oebb_composition(self):
         if "composition" in self.status:
@@ -715,14 +839,11 @@ class Trip:
                 [format_composition_element(unit) for unit in composition]
             )
 
-            newpatch = DB.execute(
-                "SELECT json_patch(?,?) AS newpatch",
-                (
-                    json.dumps({"composition": composition_text}),
-                    json.dumps(self.status_patch),
-                ),
-            ).fetchone()["newpatch"]
-            self.write_patch(json.loads(newpatch))
+            # the user's own edits win over whatever we fetched
+            self.reload_if_stale()
+            self.write_patch(
+                json_merge_patch({"composition": composition_text}, self.status_patch)
+            )
 
 
 @dataclass
@@ -750,6 +871,7 @@ class Message:
         return [cls(**row) for row in rows]
 
     @classmethod
+    @cached_per_request
     def find(cls, user_id, journey_id, channel_id):
         if row := DB.execute(
             "SELECT * FROM messages WHERE user_id = ? AND journey_id = ? AND channel_id = ?",
@@ -759,10 +881,23 @@ class Message:
         return None
 
     @classmethod
+    def find_many(cls, user_id, journey_id, channel_ids):
+        "find the messages for this trip in several channels at once, keyed by channel id"
+        if not channel_ids:
+            return {}
+        rows = DB.execute(
+            "SELECT * FROM messages WHERE user_id = ? AND journey_id = ? "
+            f"AND channel_id IN ({','.join('?' * len(channel_ids))})",
+            (user_id, journey_id, *channel_ids),
+        ).fetchall()
+        return {row["channel_id"]: cls(**row) for row in rows}
+
+    @classmethod
+    @cached_per_request
     def find_newer_than(cls, user_id, channel_id, message_id):
         if row := DB.execute(
-            "SELECT * FROM messages WHERE message_id > ? AND user_id = ? AND channel_id = ? ORDER BY message_id LIMIT 1;",
-            (message_id, user_id, channel_id),
+            "SELECT * FROM messages WHERE user_id = ? AND channel_id = ? AND message_id > ? ORDER BY message_id LIMIT 1;",
+            (user_id, channel_id, message_id),
         ).fetchone():
             return cls(**row)
         return None
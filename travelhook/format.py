@@ -6,17 +6,16 @@ import re
 import urllib
 
 import discord
-import json
+import orjson
 import tomli
-from haversine import haversine
 
 from . import database as DB
 from .helpers import (
     config,
-    fetch_headsign,
     format_delta,
     format_time,
     generate_train_link,
+    haversine_km,
     LineEmoji,
     trip_length,
     random_id,
@@ -54,7 +53,18 @@ train_types_config = {}
 with open("train_types.toml", "rb") as f:
     train_types_config = tomli.load(f)
 
+# the config doesn't change at runtime, so collect these once instead of on every lookup
+known_train_types = frozenset(
+    tt.get("type") for tt in train_types_config["train_types"]
+)
+sorted_train_types = tuple(sorted(tt for tt in known_train_types if tt))
+known_networks = frozenset(
+    tt["network"] for tt in train_types_config["train_types"] if "network" in tt
+)
+
 emoji_cache = {}
+# "a|b" emoji specs from train_types.toml, already joined into the final string
+rendered_emoji_cache = {}
 
 
 def get_network(status):
@@ -68,7 +78,7 @@ def get_network(status):
             (zugid(status),),
         ).fetchone()
         if cached:
-            operator = json.loads(cached["hafas_data"]).get("operator")
+            operator = orjson.loads(cached["hafas_data"]).get("operator")
 
     operator = operator or ""
 
@@ -88,7 +98,7 @@ def get_network(status):
         return "WL"
 
     # network SWien: S-Bahn Wien
-    if haversine((lat, lon), (48.21, 16.39)) < 70:
+    if haversine_km(lat, lon, 48.21, 16.39) < 70:
         return "SWien"
 
     # network AT: austrian trains
@@ -106,15 +116,15 @@ def get_network(status):
         return "KVB"
 
     # network BVG: U-Bahn Berlin
-    if haversine((lat, lon), (52.52, 13.41)) < 30:
+    if haversine_km(lat, lon, 52.52, 13.41) < 30:
         return "BVG"
 
     # network HHA: U-Bahn Hamburg
-    if haversine((lat, lon), (53.54, 10.01)) < 30:
+    if haversine_km(lat, lon, 53.54, 10.01) < 30:
         return "HHA"
 
     # network MVG: U-Bahn München
-    if haversine((lat, lon), (48.15, 11.54)) < 30:
+    if haversine_km(lat, lon, 48.15, 11.54) < 30:
         return "MVG"
 
     # network NRW: Stadtbahn Rhein/Ruhr
@@ -122,11 +132,11 @@ def get_network(status):
         return "NRW"
 
     # network VAG: U-Bahn Nürnberg
-    if haversine((lat, lon), (49.45, 11.05)) < 10:
+    if haversine_km(lat, lon, 49.45, 11.05) < 10:
         return "VAG"
 
     # network VGF: Stadtbahn Frankfurt
-    if haversine((lat, lon), (50.11, 8.68)) < 30:
+    if haversine_km(lat, lon, 50.11, 8.68) < 30:
         return "VGF"
 
     # network ST: third-party operators in the netherlands
@@ -155,15 +165,13 @@ def get_network(status):
 def get_display(bot, status):
     type = status["train"]["type"].strip()
     line = status["train"]["line"]
-    all_types = [t.get("type") for t in train_types_config["train_types"]]
-
     type = blanket_replace_train_type.get(type, type)
     # account for "ME RE2" instead of "RE 2"
-    if line and (type not in all_types or not type):
-        if len(line) > 2 and line[0:2] in all_types:
+    if line and (type not in known_train_types or not type):
+        if len(line) > 2 and line[0:2] in known_train_types:
             type = line[0:2]
             line = line[2:]
-        if line[0] in all_types:
+        if line[0] in known_train_types:
             type = line[0]
             line = line[1:]
 
@@ -222,8 +230,15 @@ def emoji(bot, tt):
             for emoji in bot.get_guild(gid).emojis:
                 emoji_cache[emoji.name] = str(emoji)
 
+    if rendered := rendered_emoji_cache.get(tt["emoji"]):
+        return rendered
+
     emoji = tt["emoji"].split("|")
-    return "".join([emoji_cache.get(e, f"FIXME `{tt}`") for e in emoji])
+    rendered = "".join(emoji_cache.get(e, f"FIXME `{tt}`") for e in emoji)
+    # only remember it once every part was found, the emoji server might just be missing for now
+    if all(e in emoji_cache for e in emoji):
+        rendered_emoji_cache[tt["emoji"]] = rendered
+    return rendered
 
 
 def merge_names(from_name, to_name):
@@ -328,6 +343,9 @@ def format_travelynx(bot, userid, trips, continue_link=None):
             return statuses[current_index - 1]
         return None
 
+    # needed for both the trip lines and the journey summary, walking the polylines is the expensive part
+    lengths = [trip_length(trip) for trip in trips]
+
     for i, trip in enumerate(trips):
         train = trip.status
         departure = format_time(
@@ -390,9 +408,9 @@ def format_travelynx(bot, userid, trips, continue_link=None):
                 pass
 
         route_link = generate_train_link(train)
-        headsign = shortened_name(train["fromStation"]["name"], fetch_headsign(train))
-        if fhs := train["train"].get("fakeheadsign"):
-            headsign = fhs
+        headsign = train["train"].get("fakeheadsign") or shortened_name(
+            train["fromStation"]["name"], trip.headsign or "?"
+        )
 
         # all lines in vienna have overly long HAFAS destinations not consistent with the vehicle display
         # like "Wien Winckelmannstraße (Schwendergasse 61)" when it should just be Winckelmannstraße
@@ -438,7 +456,7 @@ def format_travelynx(bot, userid, trips, continue_link=None):
                 trip_time += timedelta(seconds=30)
             desc += f"{LineEmoji.TRIP_SPEED} {format_delta(trip_time)}"
 
-            length = trip_length(trip)
+            length = lengths[i]
             if length > 0:
                 desc += (
                     f" · {length:.1f}{'km+' if trip.hafas_data.get('beeline', True) else 'km'} · "
@@ -501,8 +519,8 @@ def format_travelynx(bot, userid, trips, continue_link=None):
                     next_train["fromStation"]["latitude"],
                     next_train["fromStation"]["longitude"],
                 )
-                change_meters = haversine(
-                    train_end_location, next_train_start_location, unit="m"
+                change_meters = 1000 * haversine_km(
+                    *train_end_location, *next_train_start_location
                 )
                 if change_meters > 200.0 and not any(
                     lat == lon == 0.0
@@ -511,7 +529,7 @@ def format_travelynx(bot, userid, trips, continue_link=None):
                     desc += f"{LineEmoji.CHANGE_WALK}{LineEmoji.SPACER}*— {int(change_meters)} m —*\n"
 
         # overwrite last set embed color with the current color
-        color = discord.Color.from_str(display["color"])
+        color = display["color"]
 
     # end of format loop, finish up embed
 
@@ -540,15 +558,8 @@ def format_travelynx(bot, userid, trips, continue_link=None):
     )
     if not journey_time:
         journey_time += timedelta(seconds=30)
-    lengths = [
-        trip_length(DB.Trip.find(user.id, zugid(trip.get_unpatched_status())))
-        for trip in trips
-    ]
     includes_beelines = any(l == 0 for l in lengths) or any(
-        DB.Trip.find(user.id, zugid(trip.get_unpatched_status())).hafas_data.get(
-            "beeline", True
-        )
-        for trip in trips
+        trip.hafas_data.get("beeline", True) for trip in trips
     )
     desc += (
         f"{LineEmoji.TRIP_SUM} {len(trips)} {'trip' if len(trips) == 1 else 'trips'} · "
@@ -579,7 +590,7 @@ def format_travelynx(bot, userid, trips, continue_link=None):
 
     embed = discord.Embed(
         description=desc,
-        color=color,
+        color=discord.Color.from_str(color) if color else None,
     ).set_author(
         name=embed_title,
         icon_url=user.avatar.url,
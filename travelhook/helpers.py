@@ -1,19 +1,23 @@
 "various helper functions that do more than just pure formatting logic. the icon library lives in here too"
 from datetime import datetime, timedelta
 from zoneinfo import available_timezones, ZoneInfo
+import asyncio
+import functools
+from itertools import pairwise
 import json
+from math import asin, cos, radians, sin, sqrt
 import random
 import re
 import string
+import time
 import traceback
 import urllib
 
 import discord
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 from pyhafas import HafasClient
 from pyhafas.profile import DBProfile
 from pyhafas.types.fptf import Stopover
-from haversine import haversine
 
 from . import database as DB
 
@@ -28,10 +32,62 @@ def zugid(data):
     return f'{data["train"]["id"]}:{data["fromStation"]["scheduledTime"]}'
 
 
+http_session = None
+
+
+def get_http_session():
+    """the aiohttp session shared by all our outgoing requests, so connections can be kept
+    alive between them. created lazily since it needs a running event loop"""
+    global http_session
+    if not http_session or http_session.closed:
+        http_session = ClientSession(
+            connector=TCPConnector(limit=32, keepalive_timeout=60)
+        )
+    return http_session
+
+
+async def close_http_session():
+    if http_session and not http_session.closed:
+        await http_session.close()
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    "great-circle distance in km, same earth radius as the haversine package but without its per-call overhead"
+    phi1 = radians(lat1)
+    phi2 = radians(lat2)
+    a = (
+        sin((phi2 - phi1) / 2) ** 2
+        + cos(phi1) * cos(phi2) * sin(radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371.0088 * asin(sqrt(a))
+
+
+def rough_distance_km(lat1, lon1, lat2, lon2):
+    "equirectangular approximation, plenty accurate for telling apart stations that are miles apart"
+    dx = (lon2 - lon1) * cos(radians((lat1 + lat2) / 2)) * 111.32
+    dy = (lat2 - lat1) * 110.57
+    return sqrt(dx * dx + dy * dy)
+
+
 # globally used timezone
 tz = ZoneInfo("Europe/Berlin")
 available_tzs = available_timezones()
 hafas = HafasClient(DBProfile())
+hafas_trip_cache = {}
+HAFAS_TRIP_TTL = 60
+
+
+async def hafas_trip(jid):
+    """hafas.trip, but remembered for a minute. the circle line and 1970 fixups
+    ask about the same trip right after each other, no need to go to hafas twice.
+    pyhafas is blocking, so it runs in a thread to keep the bot responsive meanwhile"""
+    now = time.monotonic()
+    for k in [k for k, (expires, _) in hafas_trip_cache.items() if expires < now]:
+        del hafas_trip_cache[k]
+    if not jid in hafas_trip_cache:
+        trip = await asyncio.to_thread(hafas.trip, jid)
+        hafas_trip_cache[jid] = (time.monotonic() + HAFAS_TRIP_TTL, trip)
+    return hafas_trip_cache[jid][1]
 
 
 def parse_manual_time(time, timezone):
@@ -51,19 +107,34 @@ def parse_manual_time(time, timezone):
 
 async def is_token_valid(token):
     "check if a status api token actually works"
-    async with ClientSession() as session:
-        async with session.get(
-            f"{config['travelynx_instance']}/api/v1/status/{token}"
-        ) as r:
-            try:
-                data = await r.json()
-                if r.status == 200 and not "error" in data:
-                    return True
-                print(f"token {token} invalid: {r.status} {data}")
-                return False
-            except:  # pylint: disable=bare-except
-                print(f"error verifying token {token}:")
-                traceback.print_exc()
+    async with get_http_session().get(
+        f"{config['travelynx_instance']}/api/v1/status/{token}"
+    ) as r:
+        try:
+            data = await r.json()
+            if r.status == 200 and not "error" in data:
+                return True
+            print(f"token {token} invalid: {r.status} {data}")
+            return False
+        except:  # pylint: disable=bare-except
+            print(f"error verifying token {token}:")
+            traceback.print_exc()
+
+
+# delay suffixes for format_time, prebuilt for the first two hours either way
+LATE_STRINGS = tuple(f" +{minutes}′" for minutes in range(121))
+EARLY_STRINGS = tuple(f" -{minutes}′" for minutes in range(121))
+
+
+@functools.lru_cache(maxsize=1024)
+def utc_offset(timezone, hour):
+    """offset of the timezone from utc in seconds during the given hour since the epoch,
+    or None if it changes somewhere within that hour"""
+    start, end = (
+        datetime.fromtimestamp(ts, tz=timezone).utcoffset()
+        for ts in (hour * 3600, hour * 3600 + 3599)
+    )
+    return int(start.total_seconds()) if start == end else None
 
 
 def format_time(sched, actual, relative=False, timezone=tz):
@@ -71,20 +142,26 @@ def format_time(sched, actual, relative=False, timezone=tz):
     relative=True creates a discord relative timestamp that looks like "in 3 minutes"
     and updates automatically, used for the embed's final destination arrival time.
     """
-    time = datetime.fromtimestamp(actual, tz=timezone)
-
+    actual = int(actual)
     if relative:
-        return f"<t:{int(time.timestamp())}:R>"
+        return f"<t:{actual}:R>"
+
+    # offsets are the same for the whole hour pretty much always, so we can skip
+    # building a zoneinfo datetime for every single timestamp
+    offset = utc_offset(timezone, actual // 3600)
+    if offset is None:
+        offset = datetime.fromtimestamp(actual, tz=timezone).utcoffset().total_seconds()
+    local = actual + int(offset)
 
     diff = ""
     if actual > sched:
         diff = (actual - sched) // 60
-        diff = f" +{diff}′"
+        diff = LATE_STRINGS[diff] if diff <= 120 else f" +{diff}′"
     elif actual < sched:
         diff = (sched - actual) // 60
-        diff = f" -{diff}′"
+        diff = EARLY_STRINGS[diff] if diff <= 120 else f" -{diff}′"
 
-    return f"**{time:%H:%M}{diff}**"
+    return f"**{local // 3600 % 24:02}:{local // 60 % 60:02}{diff}**"
 
 
 def format_delta(delta):
@@ -166,48 +243,49 @@ def trip_length(trip):
 
     trip_length = 0
     if trip.hafas_data:
+        from_station = trip.status["fromStation"]
+        to_station = trip.status["toStation"]
         trip_started = False
-        for i, point in enumerate(trip.hafas_data["polyline"]):
+        # walk the polyline pairwise in a single pass, the last point can't start a segment anyway
+        for point, next_point in pairwise(trip.hafas_data["polyline"]):
             if (
-                point["eva"] == trip.status["fromStation"]["uic"]
-                or point["name"] == trip.status["fromStation"]["name"]
+                point["eva"] == from_station["uic"]
+                or point["name"] == from_station["name"]
             ):
                 trip_started = True
-            if (
-                point["eva"] == trip.status["toStation"]["uic"]
-                or point["name"] == trip.status["toStation"]["name"]
-                or i + 1 == len(trip.hafas_data["polyline"])
-            ):
+            if point["eva"] == to_station["uic"] or point["name"] == to_station["name"]:
                 break
             if trip_started:
-                trip_length += haversine(
-                    (point["lat"], point["lon"]),
-                    (
-                        trip.hafas_data["polyline"][i + 1]["lat"],
-                        trip.hafas_data["polyline"][i + 1]["lon"],
-                    ),
+                trip_length += haversine_km(
+                    point["lat"], point["lon"], next_point["lat"], next_point["lon"]
                 )
 
     return trip_length
 
 
-def fetch_headsign(status):
-    "try to fetch a train headsign or destination name from HAFAS"
+def json_merge_patch(target, patch):
+    """apply an RFC 7396 merge patch like sqlite's json_patch, but without
+    the round trip through the database. modifies and returns target"""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = json_merge_patch(target.get(key), value)
+    return target
 
-    if fhs := status["train"].get("fakeheadsign"):
-        return fhs
 
-    if cached := DB.DB.execute(
-        "SELECT headsign, json_patch(travelynx_status, status_patch) as status "
-        "FROM trips WHERE journey_id = ?",
-        (zugid(status),),
-    ).fetchone():
-        return (
-            json.loads(cached["status"])["train"].get("fakeheadsign")
-            or cached["headsign"]
-            or "?"
-        )
-    return "?"
+def parse_train(train):
+    """split a manually entered train like 'S 42', 'REX 3 #123' or 'walk' into
+    its type, line and (optional, marked with #) train number"""
+    train_type, _, train_line = train.partition(" ")
+    rest, _, last = train_line.rpartition(" ")
+    if last.startswith("#"):
+        return train_type, rest, last[1:]
+    return train_type, train_line, ""
 
 
 def random_id():
@@ -247,8 +325,9 @@ night_train_color = "#282559"
 tram_color = "#c5161c"
 
 # TODO fix and delete the last usage of these
+# plain ints, embeds serialize colors to that anyway
 train_type_color = {
-    k: discord.Color.from_str(v)
+    k: int(v.removeprefix("#"), 16)
     for (k, v) in {
         "S": s_bahn_color,
         "SB": metro_color,
@@ -453,3 +532,15 @@ replace_headsign = {
     # Nuremberg
     ("U3", "Großreuth _bei Schweinau"): "Großreuth bei Schweinau",
 }
+
+
+def group_by_line(replacements):
+    "turn {(line, headsign): replacement} into {line: {headsign: replacement}}"
+    by_line = {}
+    for (line, headsign), replacement in replacements.items():
+        by_line.setdefault(line, {})[headsign] = replacement
+    return by_line
+
+
+# the same table keyed by line first, most lines don't have any replacements at all
+replace_headsign_by_line = group_by_line(replace_headsign)